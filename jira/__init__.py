@@ -1,14 +1,41 @@
+import asyncio
 import re
 import time
-from typing import Dict, List, Optional, Type
+from typing import Dict, FrozenSet, List, Optional, OrderedDict, Tuple, Type
 from urllib.parse import urljoin
 
 import aiohttp
 from maubot import MessageEvent, Plugin
 from maubot.handlers import command, event
-from mautrix.types import EventType, MessageType
+from mautrix.types import EventType, MessageType, RoomID
 from mautrix.util.config import BaseProxyConfig, ConfigUpdateHelper
 
+try:
+    from orjson import loads as json_loads
+except ImportError:
+    from json import loads as json_loads
+
+URL_RE = re.compile(r"https?://\S*")
+
+# How long fetched issue titles are reused before asking JIRA again, in seconds
+ISSUE_CACHE_TTL = 300
+
+# Maximum number of issue titles kept in the cache
+MAX_CACHED_ISSUES = 4096
+
+# How often the list of JIRA projects is refreshed, in seconds
+PROJECT_REFRESH_INTERVAL = 3600
+
+# How long to wait before retrying a failed project list load, in seconds
+PROJECT_RETRY_INTERVAL = 60
+
+# How long to stop sending requests to JIRA after it rate limits us, in seconds,
+# if it doesn't say itself with a Retry-After header
+DEFAULT_RETRY_AFTER = 60
+
+# Maximum number of issues remembered for the cooldown check
+MAX_RECENT_ISSUES = 4096
+
 
 class Config(BaseProxyConfig):
     def do_update(self, helper: ConfigUpdateHelper) -> None:
@@ -40,16 +67,40 @@ class JiraPlugin(Plugin):
 
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
-        self._projects: List[str] = []
-        self._recent_issues: Dict[str, int] = {}
+        self._projects: FrozenSet[str] = frozenset()
+        self._issue_re: Optional[re.Pattern] = None
+        self._projects_loaded = False
+        self._projects_retry_at = 0.0
+        self._projects_lock = asyncio.Lock()
+        self._refresh_task: Optional[asyncio.Task] = None
+        self._recent_issues: OrderedDict[Tuple[RoomID, str], int] = OrderedDict()
+        self._issue_cache: OrderedDict[str, Tuple[float, str]] = OrderedDict()
+        self._inflight: Dict[str, asyncio.Future] = {}
+        self._backoff_until = 0.0
+        self._api_base = ""
 
         jar = aiohttp.DummyCookieJar()
-        self.nocookie = aiohttp.ClientSession(loop=self.loop, cookie_jar=jar)
+        # Keep connections to JIRA open between messages so lookups don't have
+        # to set up a new TLS connection every time
+        connector = aiohttp.TCPConnector(
+            limit=32, limit_per_host=8, keepalive_timeout=75, loop=self.loop
+        )
+        self.nocookie = aiohttp.ClientSession(
+            loop=self.loop, cookie_jar=jar, connector=connector
+        )
 
     async def start(self) -> None:
         await super().start()
         self.config.load_and_update()
-        await self._load_projects()
+        self._cache_config()
+        # Projects are loaded when the first potential issue key is seen
+        self._refresh_task = self.loop.create_task(self._periodic_refresh())
+
+    async def stop(self) -> None:
+        if self._refresh_task:
+            self._refresh_task.cancel()
+        await self.nocookie.close()
+        await super().stop()
 
     @classmethod
     def get_config_class(cls) -> Type[BaseProxyConfig]:
@@ -57,6 +108,23 @@ class JiraPlugin(Plugin):
 
     def on_external_config_update(self) -> None:
         self.config.load_and_update()
+        self._cache_config()
+
+    def _cache_config(self) -> None:
+        """Precompute values derived from the config"""
+        # Both bases end with a slash, so URLs can be built by concatenation
+        api_base = urljoin(self.config["jira_url"], self.config["rest_api_suffix"])
+        api_base = api_base.rstrip("/") + "/"
+        if api_base != self._api_base:
+            # Titles and projects from a different JIRA server are no use
+            self._issue_cache.clear()
+            self._projects_loaded = False
+            self._projects_retry_at = 0.0
+        self._api_base = api_base
+        self._browse_base = urljoin(self.config["jira_url"], "browse/")
+        self._ignored_users = frozenset(
+            nick.strip() for nick in self.config.get("ignored_users", None) or []
+        )
 
     @event.on(EventType.ROOM_MESSAGE)
     async def on_message(self, evt: MessageEvent) -> None:
@@ -78,92 +146,260 @@ class JiraPlugin(Plugin):
         """Process a message and respond with JIRA issue information if found"""
         message_body = evt.content.body
 
-        # Find all potential JIRA issue keys (PROJECT-123 format)
-        issue_matches = re.findall(r"\b([A-Z]+-\d+)\b", message_body)
+        # Every issue key contains a dash, so most messages can be skipped
+        # without running any regexes
+        if not message_body or "-" not in message_body:
+            return
 
-        if not issue_matches:
+        if not self._projects_loaded:
+            async with self._projects_lock:
+                # Don't retry a failed load on every message
+                if not self._projects_loaded and time.monotonic() >= max(
+                    self._projects_retry_at, self._backoff_until
+                ):
+                    if not await self._update_projects():
+                        self._projects_retry_at = (
+                            time.monotonic() + PROJECT_RETRY_INTERVAL
+                        )
+
+        # Nothing can match if the list of projects couldn't be loaded
+        issue_re = self._issue_re
+        if issue_re is None:
             return
 
-        # Check if issues are mentioned in URLs and skip if configured to do so
-        if not self.config["respond_to_urls"]:
-            if re.search(r"https?://\S*", message_body):
-                # Check if any issue is part of a URL
-                for issue in issue_matches:
-                    if re.search(rf"https?://\S*{re.escape(issue)}\b", message_body):
-                        issue_matches.remove(issue)
+        # Read the settings once rather than going through the config proxy
+        # for every issue
+        config = self.config
+        respond_to_urls = config["respond_to_urls"]
+        max_issues = config["max_issues_per_message"]
+        cooldown_seconds = config["issue_cooldown"]
+        include_url = config["include_url"]
+
+        # Skip issues mentioned in URLs if configured to do so
+        if respond_to_urls:
+            url_spans = []
+        else:
+            url_spans = [match.span() for match in URL_RE.finditer(message_body)]
+
+        # Find all unique issue keys of known projects, preserving order.
+        # Matches and URL spans are both ordered by position, so walk them
+        # together rather than checking every match against every URL
+        found_issues: Dict[str, None] = {}
+        span_index = 0
+        for match in issue_re.finditer(message_body):
+            issue_key = match.group(0)
+            if issue_key in found_issues:
+                continue
+            while (
+                span_index < len(url_spans)
+                and url_spans[span_index][1] <= match.start()
+            ):
+                span_index += 1
+            if (
+                span_index < len(url_spans)
+                and url_spans[span_index][0] <= match.start()
+            ):
+                continue
+            found_issues[issue_key] = None
 
-        if not issue_matches:
+        if not found_issues:
             return
 
-        # Remove duplicates while preserving order
-        unique_issues = list(dict.fromkeys(issue_matches))
+        unique_issues = list(found_issues)
 
         # Limit the number of issues to process
-        max_issues = self.config["max_issues_per_message"]
         if len(unique_issues) > max_issues:
             unique_issues = unique_issues[:max_issues]
 
-        responses = []
+        eligible = []
 
         for issue_key in unique_issues:
-            project_key = issue_key.split("-")[0]
-
-            # Check if this is a valid project
-            if project_key not in self._projects:
-                continue
-
             # Check cooldown
-            if self._is_issue_on_cooldown(issue_key):
+            if self._is_issue_on_cooldown(evt.room_id, issue_key, cooldown_seconds):
                 continue
 
-            # Fetch issue information
-            issue_info = await self._fetch_issue_info(issue_key)
-            if issue_info:
-                responses.append(issue_info)
+            eligible.append(issue_key)
 
-        if responses:
-            # Check if the original message started with [off]
-            if message_body.lower().startswith("[off]"):
-                formatted_responses = ["[off] " + response for response in responses]
+        if not eligible:
+            return
+
+        # Fetch information for all issues in a single request
+        titles = await self._fetch_issue_titles(eligible)
+
+        responses = []
+        for issue_key in eligible:
+            if issue_key not in titles:
+                continue
+            if include_url:
+                browse_url = f"{self._browse_base}{issue_key}"
+                responses.append(f"[{issue_key}]({browse_url}): {titles[issue_key]}")
             else:
-                formatted_responses = responses
+                responses.append(f"{issue_key}: {titles[issue_key]}")
+
+        if responses:
+            # Check if the original message started with [off], without
+            # lowercasing the whole message just to look at its prefix
+            prefix = "[off] " if message_body[:5].lower() == "[off]" else ""
 
             # Format as markdown list when there are multiple issues
-            if len(formatted_responses) > 1:
+            if len(responses) > 1:
                 response_text = "\n".join(
-                    f"- {response}" for response in formatted_responses
+                    f"- {prefix}{response}" for response in responses
                 )
             else:
-                response_text = "\n".join(formatted_responses)
+                response_text = prefix + responses[0]
             await evt.respond(response_text)
 
-    async def _fetch_issue_info(self, issue_key: str) -> Optional[str]:
-        """Fetch information for a specific JIRA issue"""
+    async def _fetch_issue_titles(self, issue_keys: List[str]) -> Dict[str, str]:
+        """Fetch the titles of several JIRA issues, using cached titles if possible"""
+        now = time.monotonic()
+        backing_off = now < self._backoff_until
+        titles: Dict[str, str] = {}
+        pending: Dict[str, asyncio.Future] = {}
+        to_fetch = []
+
+        for issue_key in issue_keys:
+            cached = self._issue_cache.get(issue_key)
+            # Expired titles are still better than nothing while JIRA is
+            # rate limiting us
+            if cached and (backing_off or (now - cached[0]) < ISSUE_CACHE_TTL):
+                titles[issue_key] = cached[1]
+            elif issue_key in self._inflight:
+                # Another message is already looking this issue up
+                pending[issue_key] = self._inflight[issue_key]
+            else:
+                to_fetch.append(issue_key)
+
+        if to_fetch and backing_off:
+            self.log.debug(f"Not fetching {', '.join(to_fetch)} while rate limited")
+        elif to_fetch:
+            futures = {issue_key: self.loop.create_future() for issue_key in to_fetch}
+            self._inflight.update(futures)
+            fetched: Dict[str, str] = {}
+            try:
+                fetched = await self._search_issue_titles(to_fetch)
+            finally:
+                # Clear every in-flight entry first, so a failure below can't
+                # leave later lookups waiting forever
+                for issue_key in futures:
+                    self._inflight.pop(issue_key, None)
+                now = time.monotonic()
+                for issue_key, future in futures.items():
+                    title = fetched.get(issue_key)
+                    if title is not None:
+                        # Re-insert so the oldest entries stay at the front
+                        self._issue_cache.pop(issue_key, None)
+                        self._issue_cache[issue_key] = (now, title)
+                    if not future.done():
+                        future.set_result(title)
+                while len(self._issue_cache) > MAX_CACHED_ISSUES:
+                    self._issue_cache.popitem(last=False)
+            titles.update(fetched)
+
+        for issue_key, future in pending.items():
+            # Shield the shared future so cancelling this message doesn't
+            # cancel the lookup for everyone else waiting on it
+            title = await asyncio.shield(future)
+            if title is not None:
+                titles[issue_key] = title
+
+        return titles
+
+    async def _search_issue_titles(self, issue_keys: List[str]) -> Dict[str, str]:
+        """Fetch the titles of several JIRA issues with one search request"""
         try:
-            api_base = urljoin(self.config["jira_url"], self.config["rest_api_suffix"])
-            issue_url = urljoin(api_base + "/", f"issue/{issue_key}")
-
-            response = await self.nocookie.get(issue_url)
+            search_url = f"{self._api_base}search"
+            params = {
+                "jql": f"issueKey in ({','.join(issue_keys)})",
+                "fields": "summary",
+                "maxResults": str(len(issue_keys)),
+            }
+
+            async with self.nocookie.get(search_url, params=params) as response:
+                if self._check_rate_limit(response):
+                    return {}
+                elif response.status == 200:
+                    data = await response.json(loads=json_loads)
+                    titles = {
+                        issue["key"]: issue["fields"]["summary"]
+                        for issue in data["issues"]
+                    }
+                    # Moved issues are returned under their new key, so look
+                    # up anything missing from the results by its old key
+                    missing = [key for key in issue_keys if key not in titles]
+                    if not missing:
+                        return titles
+                elif 400 <= response.status < 500:
+                    # JQL search fails outright if any of the keys doesn't exist,
+                    # so fall back to looking the issues up one by one
+                    self.log.debug(
+                        f"Issue search failed: HTTP {response.status}, "
+                        "falling back to single issue lookups"
+                    )
+                    titles = {}
+                    missing = issue_keys
+                else:
+                    self.log.debug(f"Failed to search issues: HTTP {response.status}")
+                    return {}
 
-            if response.status == 200:
-                data = await response.json()
-                title = data["fields"]["summary"]
+        except Exception as e:
+            self.log.error(f"Error searching issues {', '.join(issue_keys)}: {e}")
+            return {}
+
+        results = await asyncio.gather(
+            *(self._fetch_issue_title(issue_key) for issue_key in missing),
+            return_exceptions=True,
+        )
+        titles.update(
+            (issue_key, title)
+            for issue_key, title in zip(missing, results)
+            if isinstance(title, str)
+        )
+        return titles
+
+    async def _fetch_issue_title(self, issue_key: str) -> Optional[str]:
+        """Fetch the title of a specific JIRA issue"""
+        if time.monotonic() < self._backoff_until:
+            return None
 
-                if self.config["include_url"]:
-                    browse_url = urljoin(self.config["jira_url"], f"browse/{issue_key}")
-                    return f"[{issue_key}]({browse_url}): {title}"
+        try:
+            issue_url = f"{self._api_base}issue/{issue_key}"
+
+            # Only the summary is used, so don't make JIRA send everything else
+            params = {"fields": "summary"}
+            async with self.nocookie.get(issue_url, params=params) as response:
+                if self._check_rate_limit(response):
+                    return None
+                elif response.status == 200:
+                    data = await response.json(loads=json_loads)
+                    return data["fields"]["summary"]
                 else:
-                    return f"{issue_key}: {title}"
-            else:
-                self.log.debug(
-                    f"Failed to fetch issue {issue_key}: HTTP {response.status}"
-                )
-                return None
+                    self.log.debug(
+                        f"Failed to fetch issue {issue_key}: HTTP {response.status}"
+                    )
+                    return None
 
         except Exception as e:
             self.log.error(f"Error fetching issue {issue_key}: {e}")
             return None
 
+    def _check_rate_limit(self, response: aiohttp.ClientResponse) -> bool:
+        """Check if JIRA is rate limiting us and back off if so"""
+        if response.status not in (429, 503):
+            return False
+
+        try:
+            retry_after = float(response.headers["Retry-After"])
+        except (KeyError, ValueError):
+            retry_after = DEFAULT_RETRY_AFTER
+
+        self._backoff_until = max(self._backoff_until, time.monotonic() + retry_after)
+        self.log.warning(
+            f"JIRA responded with HTTP {response.status}, "
+            f"not sending requests for {retry_after:.0f} seconds"
+        )
+        return True
+
     @command.new(name="jira", help="JIRA plugin commands", require_subcommand=True)
     async def jira_command(self, evt: MessageEvent) -> None:
         """Base command for JIRA plugin"""
@@ -183,63 +419,76 @@ class JiraPlugin(Plugin):
     async def _update_projects(self) -> bool:
         """Fetch and update the list of JIRA projects"""
         try:
-            api_base = urljoin(self.config["jira_url"], self.config["rest_api_suffix"])
-            projects_url = urljoin(api_base + "/", "project")
-
-            response = await self.nocookie.get(projects_url)
-
-            if response.status == 200:
-                projects_data = await response.json()
-                self._projects = [project["key"] for project in projects_data]
-                self.log.info(
-                    f"Updated projects list: {len(self._projects)} projects found"
-                )
-                return True
-            else:
-                self.log.error(f"Failed to fetch projects: HTTP {response.status}")
-                self.log.error(f"{response}")
-                return False
+            projects_url = f"{self._api_base}project"
+
+            async with self.nocookie.get(projects_url) as response:
+                if self._check_rate_limit(response):
+                    return False
+                elif response.status == 200:
+                    projects_data = await response.json(loads=json_loads)
+                    self._projects = frozenset(
+                        project["key"] for project in projects_data
+                    )
+                    self._issue_re = self._compile_issue_re(self._projects)
+                    self._projects_loaded = True
+                    self.log.info(
+                        f"Updated projects list: {len(self._projects)} projects found"
+                    )
+                    return True
+                else:
+                    self.log.error(f"Failed to fetch projects: HTTP {response.status}")
+                    self.log.error(f"{response}")
+                    return False
 
         except Exception as e:
             self.log.error(f"Error updating projects: {e}")
             return False
 
-    async def _load_projects(self) -> None:
-        """Load projects on startup"""
-        if not self._projects:
-            await self._update_projects()
+    @staticmethod
+    def _compile_issue_re(projects: FrozenSet[str]) -> Optional[re.Pattern]:
+        """Build a regex matching issue keys (PROJECT-123) of the given projects"""
+        if not projects:
+            return None
+        # Longest keys first so a project never shadows a longer one it prefixes
+        alternatives = "|".join(
+            re.escape(project) for project in sorted(projects, key=len, reverse=True)
+        )
+        return re.compile(rf"\b(?:{alternatives})-\d+\b")
+
+    async def _periodic_refresh(self) -> None:
+        """Refresh the list of projects every PROJECT_REFRESH_INTERVAL seconds"""
+        while True:
+            await asyncio.sleep(PROJECT_REFRESH_INTERVAL)
+            if time.monotonic() >= self._backoff_until:
+                await self._update_projects()
 
     def _is_ignored_user(self, user_id: str) -> bool:
         """Check if a user should be ignored"""
-        ignored_users = self.config.get("ignored_users", "")
-        if not ignored_users:
-            return False
-
-        ignored_list = [nick.strip() for nick in ignored_users]
-
         # Extract displayname/localpart from Matrix ID for comparison
-        username = user_id.split(":")[0].lstrip("@")
+        username = user_id.split(":", 1)[0][1:]
 
-        return username in ignored_list
+        return username in self._ignored_users
 
-    def _is_issue_on_cooldown(self, issue_key: str) -> bool:
-        """Check if an issue is on cooldown and update the cooldown list"""
+    def _is_issue_on_cooldown(
+        self, room_id: RoomID, issue_key: str, cooldown_seconds: int
+    ) -> bool:
+        """Check if an issue is on cooldown in a room and update the cooldown list"""
         now = int(time.time())
-        cooldown_seconds = self.config["issue_cooldown"]
 
-        # Clean up old entries
-        expired_issues = [
-            key
-            for key, timestamp in self._recent_issues.items()
-            if (now - timestamp) > cooldown_seconds
-        ]
-        for key in expired_issues:
-            del self._recent_issues[key]
+        # Clean up old entries; they are stored in the order they were added,
+        # so expired entries are always at the front
+        while self._recent_issues:
+            timestamp = next(iter(self._recent_issues.values()))
+            if (now - timestamp) <= cooldown_seconds:
+                break
+            self._recent_issues.popitem(last=False)
 
         # Check if issue is on cooldown
-        if issue_key in self._recent_issues:
+        if (room_id, issue_key) in self._recent_issues:
             return True
 
-        # Add issue to recent list
-        self._recent_issues[issue_key] = now
+        # Add issue to recent list, dropping the oldest entries if it's full
+        self._recent_issues[(room_id, issue_key)] = now
+        while len(self._recent_issues) > MAX_RECENT_ISSUES:
+            self._recent_issues.popitem(last=False)
         return False